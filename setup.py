@@ -25,12 +25,16 @@ setup(
     packages=find_packages(where="src"),
     package_data={"eclipse": ["images/*"]},  # Make sure this path is correct
     install_requires=[
-        "torch>=1.0.1",  # Specify versions if needed
+        "torch>=1.9.0",  # Specify versions if needed
         "transformers>=4.34.0",  # Specify versions if needed
+        "numpy",
         "requests",  # Add any additional packages you require
         "termcolor",  # Specify versions if needed
         "prompt_toolkit",  # Specify versions if needed
     ],
+    extras_require={
+        "onnx": ["onnx", "onnxruntime"],  # Needed for --onnx_path
+    },
     entry_points={
         "console_scripts": ["eclipse=eclipse.eclipse:main"],
     },
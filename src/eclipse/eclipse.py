@@ -1,22 +1,34 @@
 import argparse
 import html
+import inspect
 import json
 import logging
 import os
+import platform
 import shutil
 import socket
-import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from importlib.metadata import version
-from typing import List, Set, Tuple
+from itertools import chain, islice
+from typing import Dict, List, Set, Tuple, Union
 from zipfile import ZipFile
 
+import numpy as np
 import requests
 import torch
 import transformers
 from prompt_toolkit import prompt
 from prompt_toolkit.history import InMemoryHistory
 from prompt_toolkit.styles import Style
-from transformers import BertForTokenClassification, BertTokenizerFast
+from transformers import (
+    AutoModelForTokenClassification,
+    AutoTokenizer,
+    PreTrainedModel,
+    PreTrainedTokenizerFast,
+)
+from transformers.modeling_outputs import TokenClassifierOutput
 
 transformers.logging.set_verbosity_error()
 # Configure basic logging
@@ -59,29 +71,257 @@ label_to_id = {
 id_to_label = {id: label for label, id in label_to_id.items()}
 
 DEFAULT_MODEL_PATH = "./ner_model_bert"
+# Seconds between checks for new versions of the models
+CHECK_INTERVAL = 24 * 60 * 60
+# Seconds the result of the last internet connectivity check stays valid
+INTERNET_CHECK_INTERVAL = 30
+internet_check = {"available": False, "checked_at": 0.0}
+# Model manager of a file processing worker process, set by init_worker
+worker_model_manager = None
+DEFAULT_BATCH_SIZE = 32
+# Typical lines are far shorter than the 512 tokens BERT accepts, and attention cost grows quadratically with length
+DEFAULT_MAX_LENGTH = 128
+# Number of batches read from an input file and processed together
+BATCHES_PER_WINDOW = 32
+READ_BUFFER_SIZE = 256 * 1024
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def get_label_arrays(num_labels):
+    """Return the label names indexed by label id, for at least num_labels ids, and whether each one is an entity label."""
+    # -100 is never predicted, and index 0 falls back to "O" like any id without a
+    # label, so a checkpoint with more labels than id_to_label still decodes
+    label_names = np.array(
+        [
+            id_to_label.get(id, "O")
+            for id in range(max(num_labels, max(id_to_label) + 1))
+        ]
+    )
+    return label_names, label_names != "O"
+
+
+def count_label_ids(predictions):
+    """Return the number of label ids needed to look up every predicted id."""
+    return int(predictions.max(initial=0)) + 1
+
+
+def cpu_supports_bf16():
+    """Check whether the CPU has native BF16 instructions."""
+    is_supported = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    return bool(is_supported and is_supported())
+
+
+def select_quantized_engine():
+    """Select the quantized kernel backend matching the CPU architecture."""
+    engine = (
+        "qnnpack" if platform.machine().lower() in ("arm64", "aarch64") else "fbgemm"
+    )
+    if engine in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = engine
+
+
+class OnnxTokenClassifier:
+    """Run an exported token classification model with ONNX Runtime, called like the PyTorch model."""
+
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, input_ids, attention_mask, **kwargs):
+        logits = self.session.run(
+            ["logits"],
+            {
+                "input_ids": input_ids.numpy(),
+                "attention_mask": attention_mask.numpy(),
+            },
+        )[0]
+        return TokenClassifierOutput(logits=torch.from_numpy(logits))
+
+
+def export_onnx_model(model, tokenizer, onnx_path):
+    """Export the model to ONNX with dynamic batch and sequence axes."""
+    example_inputs = tokenizer(
+        ["warmup", "warmup text"], padding=True, return_tensors="pt"
+    ).to(model.device)
+    # Newer versions of PyTorch default to the torch.export based exporter
+    export_options = (
+        {"dynamo": False}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters
+        else {}
+    )
+    torch.onnx.export(
+        model,
+        (example_inputs["input_ids"], example_inputs["attention_mask"]),
+        onnx_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["logits"],
+        dynamic_axes={
+            name: {0: "batch", 1: "sequence"}
+            for name in ("input_ids", "attention_mask", "logits")
+        },
+        opset_version=17,
+        **export_options,
+    )
+
+
+def get_model_fingerprint(model_path):
+    """Identify the model an ONNX file is exported from by its folder and the last modification of its files."""
+    modified_at = [
+        os.path.getmtime(os.path.join(root, name))
+        for root, _, names in os.walk(model_path)
+        for name in names
+        # The metadata is rewritten on every update check, even when the model is unchanged
+        if name != "metadata.json"
+    ]
+    return {
+        "model_path": os.path.abspath(model_path),
+        "modified_at": max(modified_at, default=0.0),
+    }
+
+
+def load_onnx_model(onnx_path, model_path, model, tokenizer, device):
+    """Load the ONNX export of the model from onnx_path, exporting it first if it does not exist yet or was made from another version of the model."""
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        logging.error("onnxruntime is not installed, running the model with PyTorch.")
+        return None
+
+    # The model each export was made from is recorded next to it
+    onnx_metadata_file = f"{onnx_path}.json"
+    model_fingerprint = get_model_fingerprint(model_path)
+    if (
+        not os.path.exists(onnx_path)
+        or load_json_file(onnx_metadata_file) != model_fingerprint
+    ):
+        export_onnx_model(model, tokenizer, onnx_path)
+        with open(onnx_metadata_file, "w") as f:
+            json.dump(model_fingerprint, f)
+
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = torch.get_num_threads()
+    providers = ["CPUExecutionProvider"]
+    if (
+        device.type == "cuda"
+        and "CUDAExecutionProvider" in ort.get_available_providers()
+    ):
+        providers.insert(0, "CUDAExecutionProvider")
+    session = ort.InferenceSession(
+        onnx_path, sess_options=session_options, providers=providers
+    )
+    return OnnxTokenClassifier(session)
+
+
+class TracedTokenClassifier:
+    """Call a TorchScript traced token classification model like the PyTorch model it was traced from."""
+
+    def __init__(self, traced_model):
+        self.traced_model = traced_model
+
+    def __call__(self, input_ids, attention_mask, **kwargs):
+        outputs = self.traced_model(input_ids, attention_mask)
+        logits = outputs["logits"] if isinstance(outputs, dict) else outputs[0]
+        return TokenClassifierOutput(logits=logits)
+
+
+def compile_model(model, tokenizer, device):
+    """Compile the model with torch.compile, or trace it with TorchScript on PyTorch versions without it, and warm it up."""
+    example_inputs = tokenize_batch(["warmup", "warmup text"], tokenizer, device)
+    try:
+        if hasattr(torch, "compile"):
+            compiled_model = torch.compile(
+                model, mode="reduce-overhead", fullgraph=False
+            )
+        else:
+            with torch.inference_mode():
+                compiled_model = TracedTokenClassifier(
+                    torch.jit.trace(
+                        model,
+                        (
+                            example_inputs["input_ids"].to(device),
+                            example_inputs["attention_mask"].to(device),
+                        ),
+                        strict=False,
+                    )
+                )
+        # Compilation happens on the first forward pass, run it here so that its
+        # cost is not charged to the first batch of lines
+        predict_tokenized_batch(example_inputs, compiled_model, device)
+        return compiled_model
+    except Exception as e:
+        logging.error(f"Could not compile the model, running it uncompiled: {e}")
+        return model
+
+
+def load_model(
+    model_path, device, bf16=False, quantize=False, onnx_path=None, compile=False
+):
+    """Load the tokenizer and model from model_path and prepare the model for inference on device."""
+    # The architecture is read from the model's config, so a smaller distilled
+    # checkpoint (e.g. DistilBERT) published under the same name loads as is
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+    model = AutoModelForTokenClassification.from_pretrained(model_path)
+    # The model has no position embeddings for tokens past its maximum length, so
+    # tokenize_batch never truncates lines to more tokens than that
+    max_positions = getattr(model.config, "max_position_embeddings", None)
+    if max_positions:
+        tokenizer.model_max_length = min(tokenizer.model_max_length, max_positions)
+    model.to(device)
+    model.eval()
+
+    # The ONNX export is made from the full precision model, ONNX Runtime then
+    # applies its own graph optimizations when the session is created
+    if onnx_path:
+        onnx_model = load_onnx_model(onnx_path, model_path, model, tokenizer, device)
+        if onnx_model is not None:
+            return tokenizer, onnx_model
+
+    # Halving the width of the weights halves the memory traffic and lets the
+    # GPU use its tensor cores, BF16 does the same on CPUs with native support
+    if device.type == "cuda":
+        model = model.half()
+    elif quantize:
+        # Dynamic INT8 quantization of the linear layers, which hold nearly all of
+        # the weights, dispatches them to the int8 GEMM kernels of the CPU
+        select_quantized_engine()
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    elif bf16:
+        if cpu_supports_bf16():
+            model = model.to(torch.bfloat16)
+        else:
+            logging.error("This CPU has no native BF16 support, running in FP32.")
+
+    if compile:
+        model = compile_model(model, tokenizer, device)
+
+    return tokenizer, model
 
 
 class ModelManager:
-    instance = None
+    instances = {}
 
     class __ModelManager:
-        def __init__(self, model_path, device):
+        def __init__(self, model_path, device, **model_options):
             self.device = torch.device(
                 "cuda" if torch.cuda.is_available() and device == "cuda" else "cpu"
             )
-
-            self.model = BertForTokenClassification.from_pretrained(model_path)
-            self.model.config.id2label = id_to_label
-            self.model.config.label2id = label_to_id
-            self.model.to(self.device)
-            self.model.eval()
-            self.tokenizer = BertTokenizerFast.from_pretrained(model_path)
+            self.tokenizer, self.model = load_model(
+                model_path, self.device, **model_options
+            )
 
     @staticmethod
-    def get_instance(model_path=DEFAULT_MODEL_PATH, device="cpu"):
-        if ModelManager.instance is None:
-            ModelManager.instance = ModelManager.__ModelManager(model_path, device)
-        return ModelManager.instance
+    def get_instance(model_path=DEFAULT_MODEL_PATH, device="cpu", **model_options):
+        key = (model_path, device, tuple(sorted(model_options.items())))
+        if key not in ModelManager.instances:
+            # Make sure the model folder exists and is up to date before loading it for the first time
+            ensure_model_folder_exists(model_path)
+            ModelManager.instances[key] = ModelManager.__ModelManager(
+                model_path, device, **model_options
+            )
+        return ModelManager.instances[key]
 
 
 def get_s3_file_etag(s3_url):
@@ -94,13 +334,17 @@ def get_s3_file_etag(s3_url):
     return response.headers.get("ETag")
 
 
-def get_local_metadata(file_name):
+def load_json_file(file_name):
     try:
         with open(file_name, "r") as f:
-            data = json.load(f)
-            return data.get("etag")
-    except FileNotFoundError:
-        return None
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def checked_recently(data):
+    """Check whether the data cached on disk was last refreshed less than CHECK_INTERVAL seconds ago."""
+    return time.time() - data.get("checked_at", 0) < CHECK_INTERVAL
 
 
 def is_run_as_package():
@@ -114,45 +358,38 @@ def get_latest_pypi_version(package_name):
         if response.status_code == 200:
             return response.json()["info"]["version"]
     except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to get latest version information: {e}", "red")
+        logging.error(f"Failed to get latest version information: {e}")
     return None
 
 
 def check_new_pypi_version(package_name="eclipse-ai"):
     """Check if a newer version of the package is available on PyPI."""
     if not is_internet_available():
-        logging.error(
-            "No internet connection available. Skipping version check.", "red"
-        )
+        logging.error("No internet connection available. Skipping version check.")
         return
 
     try:
         installed_version = version(package_name)
     except Exception as e:
-        logging.error(
-            f"Error retrieving installed version of {package_name}: {e}", "red"
-        )
+        logging.error(f"Error retrieving installed version of {package_name}: {e}")
         return
 
-    logging.info(f"Installed version: {installed_version}", "green")
+    logging.info(f"Installed version: {installed_version}")
 
     try:
         latest_version = get_latest_pypi_version(package_name)
         if latest_version is None:
             logging.error(
-                f"Error retrieving latest version of {package_name} from PyPI.", "red"
+                f"Error retrieving latest version of {package_name} from PyPI."
             )
             return
 
         if latest_version > installed_version:
             logging.info(
-                f"A newer version ({latest_version}) of {package_name} is available on PyPI. Please consider updating to access the latest features!",
-                "yellow",
+                f"A newer version ({latest_version}) of {package_name} is available on PyPI. Please consider updating to access the latest features!"
             )
     except Exception as e:
-        logging.error(
-            f"An error occurred while checking for the latest version: {e}", "red"
-        )
+        logging.error(f"An error occurred while checking for the latest version: {e}")
 
 
 def get_input_with_default(message, default_text=None):
@@ -175,65 +412,76 @@ def folder_exists_and_not_empty(folder_path):
     return True
 
 
+def copy_with_progress(source, destination, total=None):
+    """Copy the source file object to destination in large chunks, showing a progress bar when tqdm is available."""
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        shutil.copyfileobj(source, destination, DOWNLOAD_BUFFER_SIZE)
+        return
+
+    with tqdm.wrapattr(source, "read", total=total, desc="Downloading") as tracked:
+        shutil.copyfileobj(tracked, destination, DOWNLOAD_BUFFER_SIZE)
+
+
 def download_and_unzip(url, output_name):
     try:
-        # Download the file from the S3 bucket using wget with progress bar
+        # Stream the file from the S3 bucket straight to disk
         logging.info("Downloading...")
-        subprocess.run(
-            ["wget", "--progress=bar:force:noscroll", url, "-O", output_name],
-            check=True,
-        )
+        with requests.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            total = int(response.headers.get("Content-Length", 0)) or None
+            with open(output_name, "wb", buffering=DOWNLOAD_BUFFER_SIZE) as f:
+                copy_with_progress(response.raw, f, total)
 
         # Define the target directory based on the intended structure
         target_dir = os.path.splitext(output_name)[0]  # Removes '.zip' from output_name
 
-        # Extract the ZIP file
+        # Extract the ZIP file straight into the target directory
         logging.info("\nUnzipping...")
         with ZipFile(output_name, "r") as zip_ref:
-            # Here we will extract in a temp directory to inspect the structure
-            temp_dir = "temp_extract_dir"
-            zip_ref.extractall(temp_dir)
-
-            # Check if there is an unwanted nested structure
-            extracted_dirs = os.listdir(temp_dir)
-            if len(extracted_dirs) == 1 and os.path.isdir(
-                os.path.join(temp_dir, extracted_dirs[0])
+            members = zip_ref.infolist()
+            top_level = {member.filename.split("/", 1)[0] for member in members}
+
+            # Check if there is an unwanted nested structure, i.e. everything is inside one directory
+            if len(top_level) == 1 and all(
+                "/" in member.filename for member in members
             ):
-                nested_dir = os.path.join(temp_dir, extracted_dirs[0])
-                # Move content up if there is exactly one directory inside
-                if os.path.basename(nested_dir) == "ner_model_bert":
-                    shutil.move(nested_dir, target_dir)
+                nested_dir = top_level.pop()
+                # Move content up if the directory is the model folder itself
+                if nested_dir == "ner_model_bert":
+                    destination = target_dir
                 else:
-                    shutil.move(nested_dir, os.path.join(target_dir, "ner_model_bert"))
+                    destination = os.path.join(target_dir, "ner_model_bert")
+                for member in members:
+                    member.filename = member.filename[len(nested_dir) + 1 :]
+                    if member.filename:
+                        zip_ref.extract(member, destination)
             else:
-                # No nested structure, so just move all to the target directory
-                os.makedirs(target_dir, exist_ok=True)
-                for item in extracted_dirs:
-                    shutil.move(
-                        os.path.join(temp_dir, item), os.path.join(target_dir, item)
-                    )
-
-            # Cleanup temp directory
-            shutil.rmtree(temp_dir)
+                # No nested structure, so just extract all to the target directory
+                zip_ref.extractall(target_dir)
 
         # Remove the ZIP file to clean up
         os.remove(output_name)
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error occurred during download: {e}", "red")
+    except requests.exceptions.RequestException as e:
         logging.error(f"Error occurred during download: {e}")
     except Exception as e:
-        logging.error(f"Unexpected error: {e}", "red")
         logging.error(f"Unexpected error: {e}")
 
 
 def save_local_metadata(file_name, etag):
     with open(file_name, "w") as f:
-        json.dump({"etag": etag}, f)
+        json.dump({"etag": etag, "checked_at": time.time()}, f)
 
 
 def ensure_model_folder_exists(model_directory, auto_update=True):
     metadata_file = os.path.join(model_directory, "metadata.json")
-    local_etag = get_local_metadata(metadata_file)
+    metadata = load_json_file(metadata_file)
+    if folder_exists_and_not_empty(model_directory) and checked_recently(metadata):
+        return  # The model was compared against S3 recently, skip the network round trip
+
+    local_etag = metadata.get("etag")
     s3_etag = get_s3_file_etag(s3_url)
     if s3_etag is None:
         return  # Exit if there's no internet connection or other issues with S3
@@ -241,6 +489,7 @@ def ensure_model_folder_exists(model_directory, auto_update=True):
     # Check if the model directory exists and has the same etag (metadata)
     if folder_exists_and_not_empty(model_directory) and local_etag == s3_etag:
         logging.info(f"Model directory {model_directory} is up-to-date.", "green")
+        save_local_metadata(metadata_file, s3_etag)
         return  # No need to update anything as local version matches S3 version
 
     if not auto_update:
@@ -272,156 +521,358 @@ def ensure_model_folder_exists(model_directory, auto_update=True):
 
 
 def is_internet_available(host="8.8.8.8", port=53, timeout=3):
-    """Check if there is an internet connection."""
+    """Check if there is an internet connection, reusing the last answer for INTERNET_CHECK_INTERVAL seconds."""
+    if time.time() - internet_check["checked_at"] < INTERNET_CHECK_INTERVAL:
+        return internet_check["available"]
+
     try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        return True
+        with socket.create_connection((host, port), timeout=timeout):
+            available = True
     except Exception:
-        return False
+        available = False
+    internet_check.update(available=available, checked_at=time.time())
+    return available
+
+
+def get_input_device(model, device: torch.device) -> torch.device:
+    """Return the device the inputs of the model are placed on, ONNX Runtime reads them from host memory and copies them to the GPU itself."""
+    return torch.device("cpu") if isinstance(model, OnnxTokenClassifier) else device
+
+
+def tokenize_batch(
+    texts: List[str],
+    tokenizer: PreTrainedTokenizerFast,
+    device: torch.device,
+    max_length: int = DEFAULT_MAX_LENGTH,
+) -> Dict[str, torch.Tensor]:
+    """
+    Tokenize a batch of texts on the CPU, truncated to max_length tokens, or the maximum length of the model if it is lower, and padded to the longest text. The tensors are placed in pinned memory when they are headed for the GPU.
+    """
+    tokenized_inputs = tokenizer(
+        texts,
+        truncation=True,
+        padding="longest",
+        max_length=min(max_length, tokenizer.model_max_length),
+        return_tensors="pt",
+    )
+    if device.type == "cuda":
+        # Copies from pinned memory can run asynchronously with the GPU
+        return {name: tensor.pin_memory() for name, tensor in tokenized_inputs.items()}
+    return dict(tokenized_inputs)
+
+
+def predict_tokenized_batch(
+    tokenized_inputs: Dict[str, torch.Tensor],
+    model: PreTrainedModel,
+    device: torch.device,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Run a single forward pass of the BERT model over an already tokenized batch and return the predicted label ids, their confidence scores and the attention mask, each of shape [batch, tokens].
+    """
+    # The attention mask is read back on the CPU, so keep the copy that is already there
+    attention_mask = tokenized_inputs["attention_mask"].numpy().astype(bool)
+    input_device = get_input_device(model, device)
+    tokenized_inputs = {
+        name: tensor.to(input_device, non_blocking=True)
+        for name, tensor in tokenized_inputs.items()
+    }
+
+    with torch.inference_mode():
+        outputs = model(**tokenized_inputs)
+
+    # A single device to host copy per batch, everything after it is done in NumPy.
+    # Reduced precision models return FP16/BF16 logits, the confidences are computed in FP32
+    logits = outputs.logits.float().cpu().numpy()
+    # The predicted label is the argmax of the logits, and its softmax probability is
+    # 1 / sum(exp(logits - max_logit)), so the full softmax is never materialized
+    predictions = logits.argmax(axis=-1)
+    max_logits = np.take_along_axis(logits, predictions[..., np.newaxis], axis=-1)
+    confidence_scores = 1.0 / np.exp(logits - max_logits).sum(axis=-1)
+    return predictions, confidence_scores, attention_mask
+
+
+def recognize_entities_bert_batch(
+    texts: List[str],
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizerFast,
+    device: torch.device,
+    max_length: int = DEFAULT_MAX_LENGTH,
+) -> List[Tuple[Set[str], List[str], List[float], float]]:
+    """
+    Recognize entities for a batch of texts using a single forward pass of the BERT model and return, for every text, the same tuple as recognize_entities_bert.
+    """
+    predictions, confidence_scores, attention_mask = predict_tokenized_batch(
+        tokenize_batch(texts, tokenizer, get_input_device(model, device), max_length),
+        model,
+        device,
+    )
+    # Labels are looked up for the whole batch at once through a label array indexed by id
+    label_names, _ = get_label_arrays(count_label_ids(predictions))
+    predictions_labels = label_names[predictions]
+
+    results = []
+    for row_labels, row_confidences, row_mask in zip(
+        predictions_labels, confidence_scores, attention_mask
+    ):
+        # Ignore the padding added to bring every row up to the longest text
+        row_labels = row_labels[row_mask]
+        row_confidences = row_confidences[row_mask]
+
+        results.append(
+            (
+                set(row_labels[row_labels != "O"].tolist()),
+                row_labels.tolist(),
+                row_confidences.tolist(),
+                float(row_confidences.mean()),
+            )
+        )
+    return results
 
 
 def recognize_entities_bert(
     prompt_text: str,
-    model: BertForTokenClassification,
-    tokenizer: BertTokenizerFast,
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizerFast,
     device: torch.device,
 ) -> Tuple[Set[str], List[str], List[float], float]:
     """
     Recognize entities using BERT model and return unique labels detected along with all labels, their confidence scores, and average confidence score.
     """
     try:
-        tokenized_inputs = tokenizer(
-            prompt_text,
-            truncation=True,
-            padding=True,
-            max_length=512,
-            return_tensors="pt",
-        )
-        tokenized_inputs = tokenized_inputs.to(device)
+        return recognize_entities_bert_batch([prompt_text], model, tokenizer, device)[0]
+    except Exception as e:
+        logging.error(f"An error occurred in recognize_entities_bert: {e}")
+        # Return empty sets and lists if an error occurs
+        return set(), [], [], 0.0
 
-        with torch.no_grad():
-            outputs = model(**tokenized_inputs)
 
-        logits = outputs.logits
-        softmax = torch.nn.functional.softmax(logits, dim=-1)
-        confidence_scores, predictions = torch.max(softmax, dim=2)
-        average_confidence = (
-            confidence_scores.mean().item()
-        )  # Calculate average confidence
+def summarize_entities_batch(
+    lines: List[str],
+    predictions: np.ndarray,
+    confidence_scores: np.ndarray,
+    attention_mask: np.ndarray,
+    confidence_threshold: float = 0.80,
+) -> List[Tuple[str, str, float, bool]]:
+    """
+    Summarize the token predictions of a batch into one result tuple per line, ignoring padded positions.
+    """
+    label_names, entity_label_ids = get_label_arrays(count_label_ids(predictions))
+    num_lines, num_labels = len(lines), len(label_names)
 
-        predictions_labels = [
-            id_to_label.get(pred.item(), "O") for pred in predictions[0]
-        ]
-        confidence_list = (
-            confidence_scores.squeeze().tolist()
-        )  # Convert to list for easier processing
+    # Give every (line, label id) pair its own slot, so that one bincount over the
+    # unpadded tokens fills fixed size [lines, labels] count and confidence sum arrays
+    slots = (np.arange(num_lines)[:, np.newaxis] * num_labels + predictions)[
+        attention_mask
+    ]
+    label_counts = np.bincount(slots, minlength=num_lines * num_labels).reshape(
+        num_lines, num_labels
+    )
+    label_confidences = np.bincount(
+        slots,
+        weights=confidence_scores[attention_mask],
+        minlength=num_lines * num_labels,
+    ).reshape(num_lines, num_labels)
+
+    # Find the most frequent label among detected labels of every line, if any
+    entity_counts = np.where(entity_label_ids, label_counts, 0)
+    highest_ids = entity_counts.argmax(axis=1)
+    rows = np.arange(num_lines)
+    has_entity = entity_counts[rows, highest_ids] > 0
+    highest_avg_labels = np.where(
+        has_entity, label_names[highest_ids], "None"
+    )  # Use 'None' if no entity detected
+    highest_avg_confs = np.where(
+        has_entity,
+        label_confidences[rows, highest_ids]
+        / np.maximum(label_counts[rows, highest_ids], 1),
+        0.0,
+    )
+    average_confidences = label_confidences.sum(axis=1) / label_counts.sum(axis=1)
+
+    # Return the processed line information
+    return list(
+        zip(
+            lines,
+            highest_avg_labels.tolist(),
+            highest_avg_confs.tolist(),
+            (average_confidences > confidence_threshold).tolist(),
+        )
+    )
 
-        detected_labels = {label for label in predictions_labels if label != "O"}
-        return detected_labels, predictions_labels, confidence_list, average_confidence
+
+def process_line_alone(
+    line: str,
+    model_manager,
+    confidence_threshold: float = 0.80,
+    max_length: int = DEFAULT_MAX_LENGTH,
+) -> Tuple[str, str, float, bool]:
+    """
+    Process a single line in a batch of its own, returning an error result if it fails.
+    """
+    try:
+        tokenized_inputs = tokenize_batch(
+            [line],
+            model_manager.tokenizer,
+            get_input_device(model_manager.model, model_manager.device),
+            max_length,
+        )
+        return summarize_entities_batch(
+            [line],
+            *predict_tokenized_batch(
+                tokenized_inputs, model_manager.model, model_manager.device
+            ),
+            confidence_threshold,
+        )[0]
     except Exception as e:
-        logging.error(f"An error occurred in recognize_entities_bert: {e}")
-        # Return empty sets and lists if an error occurs
-        return set(), [], [], 0.0
+        logging.error(f"An error occurred while processing line: {line}, Error: {e}")
+        return line, "Error", 0.0, False
 
 
-def process_text(
-    input_text: str,
-    model_path: str,
-    device: str,
-    line_by_line: bool = False,
+def process_lines(
+    lines: List[str],
+    model_manager,
     confidence_threshold: float = 0.80,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_length: int = DEFAULT_MAX_LENGTH,
 ):
-    # Ensure the model folder exists and is up to date
-    ensure_model_folder_exists(model_path)
-    # Get the singleton instance of the model manager for the specified model path and device
-    model_manager = ModelManager.get_instance(model_path, device)
-
-    # Define an inner function for processing a single line
-    def process_single(input_line):
-        try:
-            # Process the single line using the shared model and tokenizer
-            return process_single_line(input_line, model_manager, device)
-        except Exception as e:
-            logging.error(f"An error occurred while processing single line: {e}")
-            return input_line, "Error", [0], False
-
-    # Define an inner generator function for processing line by line
-    def process_multiple(input_lines):
-        for line in input_lines.split("\n"):
+    """
+    Process lines in batches of batch_size and yield one result tuple per line, in input order.
+    """
+    batches = [
+        lines[start : start + batch_size] for start in range(0, len(lines), batch_size)
+    ]
+    if not batches:
+        return
+
+    input_device = get_input_device(model_manager.model, model_manager.device)
+    # Tokenize the next batch on a background thread while the model runs on the current one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+
+        def submit_tokenization(batch):
+            return executor.submit(
+                tokenize_batch,
+                batch,
+                model_manager.tokenizer,
+                input_device,
+                max_length,
+            )
+
+        pending_tokenization = submit_tokenization(batches[0])
+        for index, batch in enumerate(batches):
+            tokenization = pending_tokenization
+            if index + 1 < len(batches):
+                pending_tokenization = submit_tokenization(batches[index + 1])
+
             try:
-                # Yield results from processing each line individually
-                yield process_single_line(line, model_manager, device)
+                predictions, confidence_scores, attention_mask = (
+                    predict_tokenized_batch(
+                        tokenization.result(),
+                        model_manager.model,
+                        model_manager.device,
+                    )
+                )
             except Exception as e:
+                # The position of a batch does not match line numbers once lines are
+                # deduplicated and sorted, every line that still fails is logged with its text
                 logging.error(
-                    f"An error occurred while processing line: {line}, Error: {e}"
+                    f"An error occurred while processing a batch of {len(batch)} lines, retrying them one at a time, Error: {e}"
                 )
-                yield line, "Error", [0], False
-
-    # Process the input text based on the line_by_line flag
-    if line_by_line:
-        return process_multiple(input_text)  # This returns a generator
-    else:
-        return process_single(input_text)  # This returns a single tuple
+                for line in batch:
+                    yield process_line_alone(
+                        line, model_manager, confidence_threshold, max_length
+                    )
+                continue
+
+            yield from summarize_entities_batch(
+                batch,
+                predictions,
+                confidence_scores,
+                attention_mask,
+                confidence_threshold,
+            )
 
 
-def process_single_line(
-    line: str, model_manager, device, confidence_threshold: float = 0.80
+def process_lines_by_length(
+    lines: List[str],
+    model_manager,
+    confidence_threshold: float = 0.80,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_length: int = DEFAULT_MAX_LENGTH,
 ):
-    # Rest of the function remains unchanged
-
-    # Access the tokenizer and model from the model manager
-    tokenizer = model_manager.tokenizer
-    model = model_manager.model
-    device = model_manager.device  # Use device from the model manager
-
-    # Tokenize the input line
-    tokenized_inputs = tokenizer(
-        line, truncation=True, padding=True, max_length=512, return_tensors="pt"
+    """
+    Process each distinct line once, in batches of similar length, and return one result tuple per line, in input order.
+    """
+    # Repeated lines (common in logs and exports) only go through the model once
+    unique_lines = list(dict.fromkeys(lines))
+    # Every row of a batch is padded to its longest line, so batching lines of
+    # similar length keeps the model from running over mostly padding tokens
+    unique_lines.sort(key=len)
+    results = dict(
+        zip(
+            unique_lines,
+            process_lines(
+                unique_lines,
+                model_manager,
+                confidence_threshold,
+                batch_size,
+                max_length,
+            ),
+        )
     )
-    tokenized_inputs = tokenized_inputs.to(device)
+    return [results[line] for line in lines]
 
-    # Perform model inference
-    with torch.no_grad():
-        outputs = model(**tokenized_inputs)
-
-    # Process the model outputs
-    logits = outputs.logits
-    softmax = torch.nn.functional.softmax(logits, dim=-1)
-    confidence_scores, predictions = torch.max(softmax, dim=2)
-    average_confidence = confidence_scores.mean().item()
 
-    # Convert model predictions to labels
-    predictions_labels = [
-        model_manager.model.config.id2label.get(pred.item(), "O")
-        for pred in predictions[0]
-    ]
-    detected_labels = [label for label in predictions_labels if label != "O"]
-
-    # Find the most frequent label among detected labels, if any
-    if detected_labels:
-        highest_avg_label = max(set(detected_labels), key=detected_labels.count)
-        highest_avg_conf = (
-            confidence_scores[0][
-                predictions[0] == model_manager.model.config.label2id[highest_avg_label]
-            ]
-            .mean()
-            .item()
-        )
+def process_text(
+    input_text: Union[str, List[str]],
+    model_path: str,
+    device: str,
+    line_by_line: bool = False,
+    confidence_threshold: float = 0.80,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_length: int = DEFAULT_MAX_LENGTH,
+    **model_options,
+):
+    # Get the model manager for the specified model path, device and model options, loading it on first use
+    model_manager = ModelManager.get_instance(model_path, device, **model_options)
+
+    # A list of texts is always processed as separate lines, in batches
+    if isinstance(input_text, list):
+        lines = input_text
+    elif line_by_line:
+        lines = input_text.split("\n")
     else:
-        highest_avg_label = "None"  # Use 'None' if no entity detected
-        highest_avg_conf = 0.0
+        # Process the entire text as a single block, this returns a single tuple
+        return next(
+            process_lines(
+                [input_text],
+                model_manager,
+                confidence_threshold,
+                batch_size,
+                max_length,
+            )
+        )
 
-    # Return the processed line information
-    return (
-        line,
-        highest_avg_label,
-        highest_avg_conf,
-        average_confidence > confidence_threshold,
+    if line_by_line:
+        # This returns a generator
+        return process_lines(
+            lines, model_manager, confidence_threshold, batch_size, max_length
+        )
+    # This returns a list of tuples, one per line
+    return process_lines_by_length(
+        lines, model_manager, confidence_threshold, batch_size, max_length
     )
 
 
+def process_single_line(
+    line: str, model_manager, device, confidence_threshold: float = 0.80
+):
+    return next(process_lines([line], model_manager, confidence_threshold))
+
+
 def main():
+    # Eclipse only ever runs inference, so autograd bookkeeping is never needed
+    torch.set_grad_enabled(False)
+
     parser = argparse.ArgumentParser(description="Sensitive Information Detector.")
     parser.add_argument(
         "-p", "--prompt", type=str, help="Direct text prompt for recognizing entities."
@@ -471,9 +922,57 @@ def main():
         "-c",
         "--confidence_threshold",
         type=float,
-        default=0.90,
+        default=0.80,
         help="Confidence threshold for considering predictions as high confidence.",
     )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of lines to run through the model at once.",
+    )
+    parser.add_argument(
+        "-l",
+        "--max_length",
+        type=int,
+        default=DEFAULT_MAX_LENGTH,
+        help="Maximum number of tokens per line, longer lines are truncated. Values above the maximum length of the model (512 for BERT) are lowered to it.",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=max(1, (os.cpu_count() or 1) // 2),
+        help="Number of CPU threads used for model inference, defaults to half of the available cores.",
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Run the model in BF16 on CPUs with native BF16 support. On the GPU the model always runs in FP16.",
+    )
+    parser.add_argument(
+        "-q",
+        "--quantize",
+        action="store_true",
+        help="Quantize the model to INT8 for CPU inference. This may be slower on older CPUs without VNNI instructions.",
+    )
+    parser.add_argument(
+        "--onnx_path",
+        type=str,
+        help="Run the model with ONNX Runtime from this ONNX file, which is exported from the model on first use.",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the model with torch.compile before processing, which takes a while up front but speeds up inference.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes sharing the model for file processing on the CPU, each running the model on a single thread.",
+    )
 
     args = parser.parse_args()
 
@@ -482,12 +981,20 @@ def main():
         parser.print_help()
         return
 
-    # Now we ensure the model folder exists if needed
-    if args.prompt or args.file:
-        ensure_model_folder_exists(args.model_path, auto_update=True)
+    torch.set_num_threads(args.num_threads)
 
     # Determine whether to use the GPU or not based on the user's command line input
     device = "cuda" if args.use_gpu and torch.cuda.is_available() else "cpu"
+
+    # Ensure the model folder exists and load the model once, up front, so that
+    # every line processed below reuses the same tokenizer and model
+    model_options = {
+        "bf16": args.bf16,
+        "quantize": args.quantize,
+        "onnx_path": args.onnx_path,
+        "compile": args.compile,
+    }
+    ModelManager.get_instance(args.model_path, device, **model_options)
     if args.prompt:
         if args.line_by_line:
             # If line-by-line mode is enabled, iterate over generator
@@ -497,7 +1004,14 @@ def main():
                 highest_avg_confidence,
                 is_high_confidence,
             ) in process_text(
-                args.prompt, args.model_path, device, True, args.confidence_threshold
+                args.prompt,
+                args.model_path,
+                device,
+                True,
+                args.confidence_threshold,
+                args.batch_size,
+                args.max_length,
+                **model_options,
             ):
                 print(f"Processed Text: {processed_text}")
                 print(f"Highest Average Label: {highest_avg_label}")
@@ -511,7 +1025,16 @@ def main():
                 highest_avg_label,
                 highest_avg_confidence,
                 is_high_confidence,
-            ) = process_text(args.prompt, args.model_path, device, False)
+            ) = process_text(
+                args.prompt,
+                args.model_path,
+                device,
+                False,
+                args.confidence_threshold,
+                args.batch_size,
+                args.max_length,
+                **model_options,
+            )
             print(f"Processed Text: {processed_text}")
             print(f"Highest Average Label: {highest_avg_label}")
             print(f"Highest Average Confidence: {highest_avg_confidence}")
@@ -526,42 +1049,174 @@ def main():
             args.output,
             args.debug,
             args.delimiter,
+            args.batch_size,
+            model_options,
+            args.max_length,
+            args.workers,
+            args.confidence_threshold,
         )
 
 
-def process_file(file_path, model_path, device, output_path, debug, delimiter):
-    try:
-        results = []
-        with open(file_path, "r") as file:
-            file_content = file.read()
-            lines = (
-                file_content.split(delimiter)
-                if delimiter != "\n"
-                else file_content.splitlines()
+def split_file(file, delimiter):
+    """Yield the pieces of file separated by delimiter, without reading the whole file into memory."""
+    if delimiter == "\n":
+        # Split like str.splitlines(), which also breaks lines on characters such
+        # as form feeds and the Unicode line and paragraph separators
+        for line in file:
+            yield from line.splitlines()
+        return
+
+    # Whatever follows the last delimiter of a chunk is the start of the next piece.
+    # Only its last len(delimiter) - 1 characters can form a delimiter with the next
+    # chunk, so only those are scanned again and the rest is joined once at the end
+    overlap = len(delimiter) - 1
+    parts, carry = [], ""
+    while chunk := file.read(READ_BUFFER_SIZE):
+        pieces = (carry + chunk).split(delimiter)
+        if len(pieces) > 1:
+            yield "".join(parts) + pieces[0]
+            yield from pieces[1:-1]
+            parts = []
+        last = pieces[-1]
+        cut = max(len(last) - overlap, 0)
+        parts.append(last[:cut])
+        carry = last[cut:]
+    yield "".join(parts) + carry
+
+
+def render_html_line(result, debug):
+    line, highest_avg_label, highest_avg_conf, high_conf = result
+    debug_info = ""
+    if debug:
+        debug_info = f" <small>(Highest Avg. Label: {highest_avg_label}, Highest Avg. Conf.: {highest_avg_conf:.2f})</small>"
+
+    # Escape the line to convert any HTML special characters to their equivalent entities
+    colored_line = html.escape(line)
+    if high_conf:
+        colored_line = f"<span style='color: red;'>{colored_line}</span>"
+    return f"{colored_line}{debug_info}<br>\n"
+
+
+def init_worker(model_manager):
+    """Set up a worker process, which shares the model of its parent and runs it on a single thread."""
+    global worker_model_manager
+    # The workers already use every core between them, and the OpenMP thread pool
+    # inherited from the parent cannot run more than one thread after a fork
+    torch.set_num_threads(1)
+    worker_model_manager = model_manager
+
+
+def process_batch_in_worker(batch, confidence_threshold, max_length):
+    return list(
+        process_lines(
+            batch, worker_model_manager, confidence_threshold, len(batch), max_length
+        )
+    )
+
+
+def process_windows(
+    windows,
+    model_manager,
+    batch_size,
+    max_length,
+    workers=1,
+    confidence_threshold=0.80,
+):
+    """Yield the results of every window of lines, in order, spreading the batches of each window over worker processes for PyTorch models on the CPU."""
+    if workers > 1 and "fork" not in torch.multiprocessing.get_all_start_methods():
+        # The workers share the loaded model by forking, which Windows does not support
+        logging.error(
+            "Worker processes are not supported on this platform, processing the file in a single process."
+        )
+        workers = 1
+
+    if (
+        workers <= 1
+        or model_manager.device.type != "cpu"
+        or not isinstance(model_manager.model, torch.nn.Module)
+    ):
+        for window in windows:
+            yield process_lines_by_length(
+                window, model_manager, confidence_threshold, batch_size, max_length
+            )
+        return
+
+    # Forked workers reuse the weights in shared memory instead of loading their own copy
+    model_manager.model.share_memory()
+    context = torch.multiprocessing.get_context("fork")
+    process_batch = partial(
+        process_batch_in_worker,
+        confidence_threshold=confidence_threshold,
+        max_length=max_length,
+    )
+    with context.Pool(
+        workers, initializer=init_worker, initargs=(model_manager,)
+    ) as pool:
+        for window in windows:
+            # Deduplicate and sort the window like process_lines_by_length, but hand
+            # its batches to the workers, so that even a short file keeps all of them busy
+            unique_lines = list(dict.fromkeys(window))
+            unique_lines.sort(key=len)
+            batches = [
+                unique_lines[start : start + batch_size]
+                for start in range(0, len(unique_lines), batch_size)
+            ]
+            results = dict(
+                zip(
+                    unique_lines,
+                    chain.from_iterable(pool.imap(process_batch, batches)),
+                )
             )
-            for line in lines:
-                line = line.strip()
-                if line:  # Avoid processing empty lines
-                    # Assume process_text is a function that processes the text and returns a tuple
-                    # containing the processed line, highest average label, highest average confidence,
-                    # and a boolean indicating if the confidence is high.
-                    results.append(process_text(line, model_path, device))
-
-        with open(output_path, "w") as html_file:
+            yield [results[line] for line in window]
+
+
+def process_file(
+    file_path,
+    model_path,
+    device,
+    output_path,
+    debug,
+    delimiter,
+    batch_size=DEFAULT_BATCH_SIZE,
+    model_options=None,
+    max_length=DEFAULT_MAX_LENGTH,
+    workers=1,
+    confidence_threshold=0.80,
+):
+    try:
+        model_manager = ModelManager.get_instance(
+            model_path, device, **(model_options or {})
+        )
+        with (
+            open(file_path, "r", buffering=READ_BUFFER_SIZE) as file,
+            open(output_path, "w") as html_file,
+        ):
             html_file.write(
                 "<html><head><title>Processed Output</title></head><body>\n"
             )
-            for result in results:
-                line, highest_avg_label, highest_avg_conf, high_conf = result
-                debug_info = ""
-                if debug:
-                    debug_info = f" <small>(Highest Avg. Label: {highest_avg_label}, Highest Avg. Conf.: {highest_avg_conf:.2f})</small>"
-
-                # Escape the line to convert any HTML special characters to their equivalent entities
-                colored_line = html.escape(line)
-                if high_conf:
-                    colored_line = f"<span style='color: red;'>{colored_line}</span>"
-                html_file.write(f"{colored_line}{debug_info}<br>\n")
+
+            # Avoid processing empty lines
+            lines = (line.strip() for line in split_file(file, delimiter))
+            lines = (line for line in lines if line)
+
+            # Run the already loaded model over the file a window of lines at a time;
+            # each result is a tuple containing the processed line, highest average label,
+            # highest average confidence, and a boolean indicating if the confidence is high.
+            # The results of a window are written out before later ones are read.
+            windows = iter(
+                lambda: list(islice(lines, batch_size * BATCHES_PER_WINDOW)), []
+            )
+            for results in process_windows(
+                windows,
+                model_manager,
+                batch_size,
+                max_length,
+                workers,
+                confidence_threshold,
+            ):
+                html_file.write(
+                    "".join(render_html_line(result, debug) for result in results)
+                )
             html_file.write("</body></html>")
         logging.info(f"Output written to {output_path}")
     except FileNotFoundError: